@@ -2,7 +2,7 @@ import streamlit as st
 import pandas as pd
 from datetime import datetime, timedelta
 import io
-import base64
+import hashlib
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -45,59 +45,131 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-def process_data(uploaded_file):
-    """Process the uploaded Excel file and return USA and Germany DataFrames"""
+NS_PER_DAY = 86_400_000_000_000
+
+# Helper columns used by the KPI cards; hidden from tables and exports
+KPI_FLAG_COLS = ['_this_month', '_closed']
+
+def without_flags(df):
+    """Drop the KPI helper columns before showing or exporting a DataFrame"""
+    return df.drop(columns=KPI_FLAG_COLS, errors='ignore')
+
+# Entries are bounded and expire daily so a long-running server doesn't accumulate uploads
+@st.cache_data(show_spinner=False, ttl="1d", max_entries=10)
+def process_data(file_bytes, today):
+    """Process the uploaded Excel file bytes as of `today` and return USA and Germany DataFrames"""
     try:
-        # Read the Excel file
-        df = pd.read_excel(uploaded_file, dtype=str)
+        # Only the columns used below are parsed; a callable usecols skips absent ones
+        source_cols = {
+            'LIPA EX33 FZ / ExtDlvID', 'LIPA Created On', 'LIPA No. / Delivery',
+            'Process status', 'Reason code desc.', 'Customer Ref. Ord.No.',
+            'Material number', 'Material Description', 'Delivery Quantity',
+            'Model series', 'Combined Status'
+        }
+        # Arrow-backed strings run the .str methods below in vectorized C++
+        read_kwargs = dict(dtype='string[pyarrow]', usecols=lambda col: col in source_cols)
+        
+        # Read the Excel file (calamine is much faster; fall back to openpyxl if it is missing)
+        try:
+            df = pd.read_excel(io.BytesIO(file_bytes), engine='calamine', **read_kwargs)
+        except ImportError:
+            df = pd.read_excel(io.BytesIO(file_bytes), engine='openpyxl', **read_kwargs)
         
         # Process the data
         df['LIPA Created On'] = pd.to_datetime(df['LIPA Created On'], errors='coerce')
-        df['Today'] = pd.to_datetime(datetime.today().date())
-        df['Day'] = (df['Today'] - df['LIPA Created On']).dt.days
+        today_ts = pd.Timestamp(today)
         
-        def clean_lipa(row):
-            if pd.notna(row.get('Combined Status')) and "GSS Classic" in str(row['Combined Status']):
-                return "GSS classic"
-            return str(row.get('LIPA EX33 FZ / ExtDlvID')) if pd.notna(row.get('LIPA EX33 FZ / ExtDlvID')) else None
+        # Day, the >10 day filter and the age bucket all come from one int64 day array
+        created = df['LIPA Created On'].to_numpy(dtype='datetime64[ns]')
+        valid = ~np.isnat(created)
+        created_ns = np.where(valid, created.view('int64'), today_ts.value)
+        days = (today_ts.value - created_ns) // NS_PER_DAY
+        keep = valid & (days > 10)
         
-        df['LIPA EX33 FZ / ExtDlvID'] = df.apply(clean_lipa, axis=1)
-        df['Region'] = df['LIPA EX33 FZ / ExtDlvID'].astype(str).str.startswith('7').map({True: 'USA', False: 'Germany'})
+        # Mark GSS Classic rows; keep the existing ID (or missing) everywhere else
+        if 'Combined Status' in df:
+            combined_mask = df['Combined Status'].str.contains('GSS Classic', na=False)
+        else:
+            combined_mask = pd.Series(False, index=df.index)
+        lipa_ids = df['LIPA EX33 FZ / ExtDlvID'].mask(combined_mask, "GSS classic")
+        # IDs starting with 7 are USA; everything else (including missing IDs) is Germany
+        is_usa = lipa_ids.str.startswith('7').fillna(False).to_numpy(dtype=bool)
+        df['Region'] = pd.Categorical(
+            np.where(is_usa, 'USA', 'Germany'),
+            categories=['USA', 'Germany']
+        )
         df['Reason code desc.'] = df['Reason code desc.'].fillna("").replace("", "GSS classic")
-        df.loc[df['Reason code desc.'] == 'GSS classic', 'LIPA EX33 FZ / ExtDlvID'] = ""
-        df = df[df['Day'] > 10]
+        # GSS classic reasons carry no external ID; blank them while storing the column
+        df['LIPA EX33 FZ / ExtDlvID'] = lipa_ids.mask(df['Reason code desc.'] == 'GSS classic', "")
+        df = df[keep]
+        df['Day'] = days[keep].astype(np.int32)
+        
+        # Precompute the KPI flags once so the cards only have to sum booleans
+        created = df['LIPA Created On']
+        df['_this_month'] = (created.dt.year == today_ts.year) & (created.dt.month == today_ts.month)
+        df['_closed'] = df['Process status'].str.contains('closed|completed', case=False, na=False)
+        
+        # Bucket the ages once here instead of on every chart render
+        # (same edges as pd.cut(bins=[0, 30, 60, 90, inf], right=False), straight to codes)
+        df['Age Bucket'] = pd.Categorical.from_codes(
+            np.searchsorted([30, 60, 90], df['Day'].to_numpy(), side='right'),
+            categories=['0-30 days', '31-60 days', '61-90 days', '>90 days'],
+            ordered=True
+        )
+        # Model series for the heatmap: first 4 characters of the material number
+        df['Model'] = df['Material number'].str.slice(0, 4)
+        
+        # Compact dtypes: categorical low-cardinality text
+        category_cols = ['Process status', 'Reason code desc.', 'Model series', 'Model']
+        df[category_cols] = df[category_cols].astype('category')
         
         required_cols = [
             'LIPA EX33 FZ / ExtDlvID', 'LIPA Created On', 'Day',
             'LIPA No. / Delivery', 'Process status', 'Reason code desc.',
             'Customer Ref. Ord.No.', 'Material number', 'Material Description',
-            'Delivery Quantity', 'Model series'
+            'Delivery Quantity', 'Model series', 'Age Bucket', 'Model'
         ]
         
-        def prepare_df(region_df):
-            region_df = region_df[required_cols].copy()
-            region_df = region_df.sort_values(by='Day', ascending=False).reset_index(drop=True)
-            region_df.insert(0, 'Sr No.', range(1, len(region_df) + 1))
+        # Sort once and slice each region out of the shared frame
+        df = df[required_cols + KPI_FLAG_COLS + ['Region']].sort_values(
+            by='Day', ascending=False, kind='stable', ignore_index=True
+        )
+        
+        def prepare_df(region):
+            region_df = df.loc[df['Region'] == region].drop(columns='Region').reset_index(drop=True)
+            for col in category_cols:
+                region_df[col] = region_df[col].cat.remove_unused_categories()
+            region_df.insert(0, 'Sr No.', np.arange(1, len(region_df) + 1, dtype=np.int32))
             return region_df
         
-        usa_df = prepare_df(df[df['Region'] == 'USA']) if 'USA' in df['Region'].values else pd.DataFrame()
-        germany_df = prepare_df(df[df['Region'] == 'Germany']) if 'Germany' in df['Region'].values else pd.DataFrame()
+        # One bincount over the category codes tells us which regions are present
+        region_counts = df['Region'].value_counts(sort=False)
+        usa_df = prepare_df('USA') if region_counts['USA'] else pd.DataFrame()
+        germany_df = prepare_df('Germany') if region_counts['Germany'] else pd.DataFrame()
         
         return True, usa_df, germany_df
     except Exception as e:
         return False, str(e), None
 
-def get_table_download_link(df, filename, button_text):
-    """Generates a link to download the dataframe as an Excel file"""
-    if df.empty:
-        return ""
+@st.cache_data(show_spinner=False, ttl="1d", max_entries=30)
+def to_excel_bytes(_sheets, data_key, filename):
+    """Serialize a {sheet name: dataframe} dict to Excel bytes (cached per upload and file name)"""
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Sheet1')
-    b64 = base64.b64encode(output.getvalue()).decode()
-    href = f'<a href="data:application/octet-stream;base64,{b64}" download="{filename}">\
-            <button class="stDownloadButton">{button_text}</button></a>'
-    return href
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        for sheet_name, df in _sheets.items():
+            df.to_excel(writer, index=False, sheet_name=sheet_name)
+    return output.getvalue()
+
+def create_download_button(df, filename, button_text, data_key):
+    """Renders a button to download the dataframe as an Excel file"""
+    if df.empty:
+        return None
+    st.download_button(
+        button_text,
+        data=to_excel_bytes({'Sheet1': df}, data_key, filename),
+        file_name=filename,
+        mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    )
 
 def send_email(receiver_email, subject, body, attachment=None, filename=None):
     """Send email with optional attachment"""
@@ -141,8 +213,12 @@ uploaded_file = st.sidebar.file_uploader("Choose an Excel file", type=["xlsx", "
 
 if uploaded_file is not None:
     # Process the file
+    file_bytes = uploaded_file.getvalue()
+    today = datetime.today().date()
+    # Cheap per-upload key for the chart and export caches (avoids hashing the frames)
+    data_key = f"{hashlib.sha256(file_bytes).hexdigest()}:{today}"
     with st.spinner('Processing your file...'):
-        success, usa_df, germany_df = process_data(uploaded_file)
+        success, usa_df, germany_df = process_data(file_bytes, today)
     
     if success:
         st.sidebar.success("File processed successfully!")
@@ -157,35 +233,36 @@ if uploaded_file is not None:
             
             # 2. Aging Trend
             st.subheader("Aging Trend")
-            create_aging_trend(usa_df, "USA")
+            st.plotly_chart(create_aging_trend(usa_df, "USA", data_key), use_container_width=True)
             
             # 3. Aging Distribution
             st.subheader("Aging Bucket Distribution")
-            create_aging_distribution(usa_df, "USA")
+            st.plotly_chart(create_aging_distribution(usa_df, "USA", data_key), use_container_width=True)
             
             # 4. Reason Distribution
             st.subheader("LIPAs by Reason")
-            create_reason_distribution(usa_df, "USA")
+            st.plotly_chart(create_reason_distribution(usa_df, "USA", data_key), use_container_width=True)
             
             # 5. Process Status
             st.subheader("Process Status Distribution")
-            create_status_donut(usa_df, "USA")
+            st.plotly_chart(create_status_donut(usa_df, "USA", data_key), use_container_width=True)
             
             # 6. Top Aging Table
             create_top_aging_table(usa_df, "USA")
             
             # 7. Heatmap
             st.subheader("LIPAs by Model vs. Reason")
-            create_heatmap(usa_df, "USA")
+            st.plotly_chart(create_heatmap(usa_df, "USA", data_key), use_container_width=True)
             
             # Raw Data Section
             with st.expander("View Raw USA Data"):
-                st.dataframe(usa_df, use_container_width=True)
-                st.markdown(get_table_download_link(
-                    usa_df, 
-                    "USA_NotDispatched.xlsx", 
-                    "⬇️ Download USA Data"
-                ), unsafe_allow_html=True)
+                st.dataframe(without_flags(usa_df), use_container_width=True)
+                create_download_button(
+                    without_flags(usa_df),
+                    "USA_NotDispatched.xlsx",
+                    "⬇️ Download USA Data",
+                    data_key
+                )
         else:
             st.warning("No USA data found in the uploaded file.")
         
@@ -202,35 +279,36 @@ if uploaded_file is not None:
             
             # 2. Aging Trend
             st.subheader("Aging Trend")
-            create_aging_trend(germany_df, "Germany")
+            st.plotly_chart(create_aging_trend(germany_df, "Germany", data_key), use_container_width=True)
             
             # 3. Aging Distribution
             st.subheader("Aging Bucket Distribution")
-            create_aging_distribution(germany_df, "Germany")
+            st.plotly_chart(create_aging_distribution(germany_df, "Germany", data_key), use_container_width=True)
             
             # 4. Reason Distribution
             st.subheader("LIPAs by Reason")
-            create_reason_distribution(germany_df, "Germany")
+            st.plotly_chart(create_reason_distribution(germany_df, "Germany", data_key), use_container_width=True)
             
             # 5. Process Status
             st.subheader("Process Status Distribution")
-            create_status_donut(germany_df, "Germany")
+            st.plotly_chart(create_status_donut(germany_df, "Germany", data_key), use_container_width=True)
             
             # 6. Top Aging Table
             create_top_aging_table(germany_df, "Germany")
             
             # 7. Heatmap
             st.subheader("LIPAs by Model vs. Reason")
-            create_heatmap(germany_df, "Germany")
+            st.plotly_chart(create_heatmap(germany_df, "Germany", data_key), use_container_width=True)
             
             # Raw Data Section
             with st.expander("View Raw Germany Data"):
-                st.dataframe(germany_df, use_container_width=True)
-                st.markdown(get_table_download_link(
-                    germany_df, 
-                    "Germany_NotDispatched.xlsx", 
-                    "⬇️ Download Germany Data"
-                ), unsafe_allow_html=True)
+                st.dataframe(without_flags(germany_df), use_container_width=True)
+                create_download_button(
+                    without_flags(germany_df),
+                    "Germany_NotDispatched.xlsx",
+                    "⬇️ Download Germany Data",
+                    data_key
+                )
         else:
             st.warning("No Germany data found in the uploaded file.")
         
@@ -242,20 +320,19 @@ if uploaded_file is not None:
         
         if st.sidebar.button("📧 Send Email"):
             if email:
-                # Create a single Excel file with both sheets for email
-                output = io.BytesIO()
-                with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                    if not usa_df.empty:
-                        usa_df.to_excel(writer, sheet_name='USA', index=False)
-                    if not germany_df.empty:
-                        germany_df.to_excel(writer, sheet_name='Germany', index=False)
+                # Create a single Excel file with both sheets for email (cached, so repeat sends are cheap)
+                sheets = {
+                    sheet_name: without_flags(region_df)
+                    for sheet_name, region_df in [('USA', usa_df), ('Germany', germany_df)]
+                    if not region_df.empty
+                }
                 
                 # Send email with attachment
                 success, message = send_email(
                     email,
                     email_subject,
                     email_body,
-                    attachment=output.getvalue(),
+                    attachment=to_excel_bytes(sheets, data_key, "LIPA_NotDispatched_Report.xlsx"),
                     filename="LIPA_NotDispatched_Report.xlsx"
                 )
                 
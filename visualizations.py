@@ -2,9 +2,12 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from datetime import datetime, timedelta
 import numpy as np
 
+# Figures are cached per (upload, region): callers pass a cheap data_key for the
+# upload and the frame goes in as `_df`, so Streamlit never hashes its rows
+cache_figure = st.cache_data(show_spinner=False, ttl="1d", max_entries=100)
+
 def create_kpi_cards(df, region_name):
     """Create KPI cards for the dashboard"""
     if df.empty:
@@ -15,11 +18,8 @@ def create_kpi_cards(df, region_name):
     lipas_30_days = len(df[df['Day'] > 30])
     lipas_60_days = len(df[df['Day'] > 60])
     
-    # Calculate LIPAs closed this month (assuming 'Process status' indicates closure)
-    current_month = datetime.now().month
-    current_year = datetime.now().year
-    this_month = df[df['LIPA Created On'].dt.month == current_month]
-    closed_this_month = len(this_month[this_month['Process status'].astype(str).str.contains('closed|completed', case=False, na=False)])
+    # Calculate LIPAs closed this month (flags are precomputed in process_data)
+    closed_this_month = int((df['_this_month'] & df['_closed']).sum())
     
     avg_aging_days = df['Day'].mean()
     
@@ -39,40 +39,44 @@ def create_kpi_cards(df, region_name):
     with col5:
         st.metric("⏱️ Avg. Aging Days", f"{avg_aging_days:.1f}")
 
-def create_aging_trend(df, region_name):
+@cache_figure
+def create_aging_trend(_df, region_name, data_key):
     """Create LIPA Aging Trend line chart"""
-    if df.empty:
+    if _df.empty:
         return None
     
-    # Create weekly bins
-    df_weekly = df.copy()
-    df_weekly['Week'] = df_weekly['LIPA Created On'].dt.to_period('W').dt.start_time
+    # Create weekly bins and age flags (plain sums keep the groupby vectorized)
+    df_weekly = _df[['LIPA No. / Delivery']].assign(
+        Week=_df['LIPA Created On'].dt.to_period('W').dt.start_time,
+        over_30=(_df['Day'] > 30).astype(np.int32),
+        over_60=(_df['Day'] > 60).astype(np.int32)
+    )
     
     # Group by week and count LIPAs in different age groups
-    weekly_counts = df_weekly.groupby('Week').agg(
+    weekly_counts = df_weekly.groupby('Week', sort=True).agg(
         total=('LIPA No. / Delivery', 'count'),
-        over_30_days=('Day', lambda x: (x > 30).sum()),
-        over_60_days=('Day', lambda x: (x > 60).sum())
+        over_30_days=('over_30', 'sum'),
+        over_60_days=('over_60', 'sum')
     ).reset_index()
     
-    # Create line chart
+    # Create line chart (WebGL traces keep rendering cheap for long histories)
     fig = go.Figure()
     
-    fig.add_trace(go.Scatter(
+    fig.add_trace(go.Scattergl(
         x=weekly_counts['Week'],
         y=weekly_counts['total'],
         name='Total LIPAs',
         line=dict(color='#1f77b4', width=2)
     ))
     
-    fig.add_trace(go.Scatter(
+    fig.add_trace(go.Scattergl(
         x=weekly_counts['Week'],
         y=weekly_counts['over_30_days'],
         name='>30 Days',
         line=dict(color='#ff7f0e', width=2, dash='dash')
     ))
     
-    fig.add_trace(go.Scatter(
+    fig.add_trace(go.Scattergl(
         x=weekly_counts['Week'],
         y=weekly_counts['over_60_days'],
         name='>60 Days',
@@ -87,20 +91,17 @@ def create_aging_trend(df, region_name):
         hovermode="x unified"
     )
     
-    st.plotly_chart(fig, use_container_width=True)
+    return fig
 
-def create_aging_distribution(df, region_name):
+@cache_figure
+def create_aging_distribution(_df, region_name, data_key):
     """Create Aging Bucket Distribution bar chart"""
-    if df.empty:
+    if _df.empty:
         return None
     
-    # Create age buckets
-    bins = [0, 30, 60, 90, float('inf')]
-    labels = ['0-30 days', '31-60 days', '61-90 days', '>90 days']
-    df['Age Bucket'] = pd.cut(df['Day'], bins=bins, labels=labels, right=False)
-    
-    # Count by age bucket and reason
-    age_reason_counts = df.groupby(['Age Bucket', 'Reason code desc.']).size().reset_index(name='Count')
+    # Count by age bucket and reason (Age Bucket is precomputed in process_data)
+    labels = list(_df['Age Bucket'].cat.categories)
+    age_reason_counts = _df.groupby(['Age Bucket', 'Reason code desc.'], observed=True).size().reset_index(name='Count')
     
     # Create stacked bar chart
     fig = px.bar(
@@ -113,15 +114,16 @@ def create_aging_distribution(df, region_name):
         category_orders={"Age Bucket": labels}
     )
     
-    st.plotly_chart(fig, use_container_width=True)
+    return fig
 
-def create_reason_distribution(df, region_name):
+@cache_figure
+def create_reason_distribution(_df, region_name, data_key):
     """Create LIPAs by Reason horizontal bar chart"""
-    if df.empty:
+    if _df.empty:
         return None
     
     # Count by reason
-    reason_counts = df['Reason code desc.'].value_counts().reset_index()
+    reason_counts = _df['Reason code desc.'].value_counts().reset_index()
     reason_counts.columns = ['Reason', 'Count']
     
     # Create horizontal bar chart
@@ -136,15 +138,16 @@ def create_reason_distribution(df, region_name):
         color_continuous_scale='Blues'
     )
     
-    st.plotly_chart(fig, use_container_width=True)
+    return fig
 
-def create_status_donut(df, region_name):
+@cache_figure
+def create_status_donut(_df, region_name, data_key):
     """Create Process Status donut chart"""
-    if df.empty:
+    if _df.empty:
         return None
     
     # Count by process status
-    status_counts = df['Process status'].value_counts().reset_index()
+    status_counts = _df['Process status'].value_counts().reset_index()
     status_counts.columns = ['Status', 'Count']
     
     # Create donut chart
@@ -161,16 +164,20 @@ def create_status_donut(df, region_name):
         showlegend=False
     )
     
-    st.plotly_chart(fig, use_container_width=True)
+    return fig
 
 def create_top_aging_table(df, region_name):
     """Create Top 10 Aging LIPAs table"""
     if df.empty:
         return None
     
-    # Get top 10 oldest LIPAs
-    top_aging = df.nlargest(10, 'Day')[['LIPA No. / Delivery', 'LIPA Created On', 'Day', 
-                                      'Material number', 'Customer Ref. Ord.No.', 'Reason code desc.']]
+    # Get top 10 oldest LIPAs (partial partition, then order just those rows)
+    day = df['Day'].to_numpy()
+    k = min(10, len(day))
+    idx = np.argpartition(-day, k - 1)[:k]
+    top_idx = idx[np.lexsort((idx, -day[idx]))]
+    top_aging = df.iloc[top_idx][['LIPA No. / Delivery', 'LIPA Created On', 'Day', 
+                                  'Material number', 'Customer Ref. Ord.No.', 'Reason code desc.']]
     
     # Format columns
     top_aging['LIPA Created On'] = top_aging['LIPA Created On'].dt.strftime('%Y-%m-%d')
@@ -190,26 +197,22 @@ def create_top_aging_table(df, region_name):
         hide_index=True
     )
 
-def create_heatmap(df, region_name):
+@cache_figure
+def create_heatmap(_df, region_name, data_key):
     """Create Heat Map: LIPAs by Model vs. Reason"""
-    if df.empty:
+    if _df.empty:
         return None
     
-    # Extract model series (first 3-4 characters of material number)
-    df['Model'] = df['Material number'].astype(str).str[:4]
-    
-    # Create pivot table for heatmap
-    heatmap_data = df.pivot_table(
-        index='Model',
-        columns='Reason code desc.',
-        values='LIPA No. / Delivery',
-        aggfunc='count',
-        fill_value=0
-    ).reset_index()
+    # Count LIPA numbers per Model x Reason in one grouped pass (Model is precomputed in process_data)
+    heatmap_data = (
+        _df.groupby(['Model', 'Reason code desc.'], observed=True)['LIPA No. / Delivery']
+        .count()
+        .unstack(fill_value=0)
+    )
     
     # Create heatmap
     fig = px.imshow(
-        heatmap_data.set_index('Model'),
+        heatmap_data,
         labels=dict(x="Reason", y="Model", color="Count"),
         title=f"{region_name} - LIPAs by Model vs. Reason",
         color_continuous_scale='YlOrRd'
@@ -222,4 +225,4 @@ def create_heatmap(df, region_name):
         coloraxis_colorbar_title="Count"
     )
     
-    st.plotly_chart(fig, use_container_width=True)
+    return fig